@@ -7,19 +7,24 @@ and provides code execution capabilities with persistent state.
 """
 
 from mcp.server.fastmcp import FastMCP
-import json
+import asyncio
+import orjson
 import zmq
-import uuid
 import hmac
 import hashlib
 import time
 import subprocess
 import tempfile
 import os
+import re
+import atexit
 import signal
+import socket
+import sys
+import threading
 from importlib import resources
-from datetime import datetime
 from pathlib import Path
+from typing import List
 
 # Initialize the MCP server
 mcp = FastMCP("ipython-kernel")
@@ -30,14 +35,126 @@ context = None
 shell_socket = None
 iopub_socket = None
 control_socket = None
+iopub_thread = None
+iopub_thread_stop = None
+hmac_template = None
 
 # Global kernel process state
 kernel_process = None
 kernel_pid_file = None
 
+# PID file path -> kernel process for every kernel start_kernel launched; at exit
+# only the files of kernels that have since exited are deleted
+_pid_files = {}
+
 # Track non-blocking executions
 pending_executions = {}
 
+# Guards pending_executions and the ExecState objects in it, which the IOPub
+# reader thread updates while tool calls read them
+_state_lock = threading.Lock()
+
+# Set by the signal handlers; a watcher thread performs the actual shutdown
+_shutdown_event = threading.Event()
+
+# Finished executions nobody collected with check_execution are dropped
+# PENDING_TTL seconds after they finished, checked once more than PENDING_REAP_THRESHOLD are tracked
+PENDING_REAP_THRESHOLD = 64
+PENDING_TTL = 600
+
+# How often (ms) the IOPub reader thread wakes up to check whether it should stop
+IOPUB_POLL_INTERVAL_MS = 100
+
+# Seconds start_kernel waits for a freshly launched kernel to bind its ports
+KERNEL_START_TIMEOUT = 5.0
+
+# Seconds start_kernel waits after the shell port opens before confirming the
+# kernel is still alive; a kernel that fails to bind a later port exits by then
+KERNEL_SETTLE_DELAY = 0.2
+
+# Connection-file fields naming the ports a kernel binds
+KERNEL_PORT_FIELDS = ('shell_port', 'iopub_port', 'stdin_port', 'control_port', 'hb_port')
+
+# Fields every connection file must have, with their expected types
+CONNECTION_FIELDS = {'ip': str, **{field: int for field in KERNEL_PORT_FIELDS}, 'key': str}
+
+# Seconds connect_to_kernel waits for the kernel to answer its warm-up kernel_info_request
+WARMUP_TIMEOUT = 2.0
+
+# Seconds the warm-up waits for IOPub to see each kernel_info_request go idle
+# before repeating it
+WARMUP_RETRY_INTERVAL = 0.1
+
+def _timeout_from_env(name, default):
+    """Read a timeout in seconds from env var name, falling back to default if unset or invalid."""
+    value = os.environ.get(name)
+    if value is None:
+        return default
+    try:
+        seconds = float(value)
+    except ValueError:
+        seconds = None
+    if seconds is None or not 0 < seconds < float('inf'):
+        # stderr, since stdout carries the MCP protocol
+        print(f"ipython-mcp: ignoring {name}={value!r}, expected a positive number of seconds; "
+              f"using {default:g}", file=sys.stderr)
+        return default
+    return seconds
+
+
+# Seconds execute_code and execute_many wait before returning a timeout warning;
+# an absolute deadline, so a cell that keeps printing cannot extend it
+EXEC_TIMEOUT = _timeout_from_env('IPYTHON_MCP_EXEC_TIMEOUT', 1.0)
+
+# One Jupyter session id for the whole server process, shared by every message
+# we send; bytes because it is only used in the header template and IOPub filter
+SESSION_BYTES = os.urandom(16).hex().encode()
+
+# Wire-protocol frames that never change between messages
+DELIMITER = b"<IDS|MSG>"
+EMPTY_FRAME = b"{}"
+
+# Message header with the session baked in; only msg_id, date and msg_type vary.
+# Every substituted value is hex, an ISO timestamp or a fixed msg_type, so none
+# of them needs JSON escaping and the header can skip the encoder entirely.
+HEADER_TEMPLATE = (
+    b'{"msg_id":"%b","username":"ipython-mcp","session":"' + SESSION_BYTES + b'",'
+    b'"date":"%b","msg_type":"%b","version":"5.3"}'
+)
+
+# execute_request content fields that never change; only "code" is added per call
+EXECUTE_CONTENT_STATIC = {
+    "silent": False,
+    "store_history": True,
+    "user_expressions": {},
+    "allow_stdin": False,
+    "stop_on_error": True,
+}
+
+# execute_request content is spliced around the JSON-encoded code string:
+# PREFIX + orjson.dumps(code) + SUFFIX, where SUFFIX is the static fields above
+EXECUTE_CONTENT_PREFIX = b'{"code":'
+EXECUTE_CONTENT_SUFFIX = b"," + orjson.dumps(EXECUTE_CONTENT_STATIC)[1:]
+
+# Content for an empty, silent execute_request used only to evaluate user_expressions
+SILENT_CONTENT_STATIC = {
+    "code": "",
+    "silent": True,
+    "store_history": False,
+    "allow_stdin": False,
+    "stop_on_error": False,
+}
+
+# High-water mark for queued messages per socket; IOPub bursts (e.g. a print loop)
+# easily exceed libzmq's default of 1000 and would otherwise be dropped
+SOCKET_HWM = 10000
+
+# How long (ms) a shell/control send may wait for the kernel connection to be up
+SEND_TIMEOUT_MS = 1000
+
+# Matches ANSI SGR color/style sequences in kernel tracebacks
+ANSI_RE = re.compile(r'\x1b\[[0-9;]*m')
+
 
 def resolve_connection_file(connection_file: str = None) -> str:
     """
@@ -68,74 +185,484 @@ def resolve_connection_file(connection_file: str = None) -> str:
         return str(package_dir / 'default_connection.json')
 
 
-def sign_message(msg_lst, key):
-    """Sign a message with HMAC"""
-    h = hmac.new(key.encode('utf-8'), digestmod=hashlib.sha256)
+def _get_context():
+    """
+    Return the process-wide ZMQ context, creating it on first use.
+    
+    The context (and its I/O thread) is kept across reconnects; only the
+    sockets are recreated. It is torn down once at interpreter exit.
+    """
+    global context
+    
+    if context is None:
+        context = zmq.Context.instance(io_threads=1)
+    return context
+
+
+def _release_context():
+    """atexit hook: stop the IOPub reader, then close any open sockets and the context."""
+    _stop_iopub_thread()
+    # destroy() closes any still-open sockets first; a bare term() would block on them
+    zmq.Context.instance().destroy(linger=0)
+
+
+atexit.register(_release_context)
+
+
+def _new_socket(socket_type):
+    """
+    Create a socket on the shared context tuned for small, bursty Jupyter messages.
+    
+    libzmq already enables TCP_NODELAY on every TCP connection, so only the
+    queue limits, linger and keepalive need setting here. Request (DEALER)
+    sockets also set IMMEDIATE, so a send to a kernel that is not connected
+    fails after SEND_TIMEOUT_MS instead of queueing silently until the
+    caller's own timeout.
+    """
+    sock = _get_context().socket(socket_type)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.setsockopt(zmq.RCVHWM, SOCKET_HWM)
+    sock.setsockopt(zmq.SNDHWM, SOCKET_HWM)
+    sock.setsockopt(zmq.TCP_KEEPALIVE, 1)
+    if socket_type == zmq.DEALER:
+        sock.setsockopt(zmq.IMMEDIATE, 1)
+        sock.setsockopt(zmq.SNDTIMEO, SEND_TIMEOUT_MS)
+    return sock
+
+
+# (whole second, "YYYY-MM-DDTHH:MM:SS" for it) reused by _iso_now within that second
+_date_cache = (None, None)
+
+
+def _iso_now():
+    """
+    Return the current UTC time as ISO-8601 bytes for message headers.
+    
+    Formatting the date/time part once per second and only appending
+    microseconds per call is about twice as fast as datetime.now().isoformat().
+    """
+    global _date_cache
+    
+    now = time.time()
+    second = int(now)
+    cached_second, prefix = _date_cache
+    if cached_second != second:
+        prefix = time.strftime("%Y-%m-%dT%H:%M:%S", time.gmtime(second)).encode()
+        _date_cache = (second, prefix)
+    return b"%b.%06dZ" % (prefix, (now - second) * 1_000_000)
+
+
+def _new_msg_id():
+    """Return a fresh 32-char hex message id (Jupyter only requires uniqueness)"""
+    return os.urandom(16).hex()
+
+
+def sign_message(msg_lst):
+    """Sign a message with the HMAC keyed at connect time"""
+    h = hmac_template.copy()
     for m in msg_lst:
         h.update(m)
     return h.hexdigest().encode('utf-8')
 
 
-def _process_iopub_messages():
-    """Collect pending messages from the IOPub socket for non-blocking executions."""
-    global pending_executions, iopub_socket
+def _send_message(sock, msg_id, msg_type, content):
+    """
+    Build, sign and send one Jupyter wire-protocol message.
+    
+    content is the already JSON-encoded content frame. All requests sent by
+    this server have empty parent_header and metadata, so those frames are
+    the shared EMPTY_FRAME constant.
+    """
+    header = HEADER_TEMPLATE % (
+        msg_id.encode(),
+        _iso_now(),
+        msg_type.encode(),
+    )
+    
+    msg_parts = [header, EMPTY_FRAME, EMPTY_FRAME, content]
+    signature = sign_message(msg_parts)
+    
+    try:
+        sock.send_multipart([b"", DELIMITER, signature, *msg_parts], copy=False)
+    except zmq.Again:
+        raise ConnectionError("Kernel is not reachable (is it still running?)") from None
+
+
+class ExecState:
+    """Output collected so far for one execute_request, keyed by msg_id in pending_executions."""
+
+    __slots__ = ("results", "streams", "errors", "finished", "interrupted", "finished_at")
+
+    def __init__(self):
+        self.results = []
+        self.streams = []
+        self.errors = []
+        self.finished = threading.Event()  # set by the IOPub reader once the kernel goes idle
+        self.interrupted = False
+        self.finished_at = None  # monotonic time the kernel went idle, for PENDING_TTL
 
-    if not iopub_socket or not pending_executions:
+    @property
+    def done(self):
+        return self.finished.is_set()
+
+
+def _send_execute_request(code):
+    """Send an execute_request on the shell socket and start tracking its output.
+
+    Returns:
+        msg_id of the request, which is also the key into pending_executions
+    """
+    global pending_executions
+
+    msg_id = _new_msg_id()
+
+    content = b"".join((EXECUTE_CONTENT_PREFIX, orjson.dumps(code), EXECUTE_CONTENT_SUFFIX))
+
+    # Register before sending so no reply can arrive for an untracked msg_id
+    with _state_lock:
+        pending_executions[msg_id] = ExecState()
+
+    try:
+        _send_message(shell_socket, msg_id, "execute_request", content)
+    except Exception:
+        with _state_lock:
+            pending_executions.pop(msg_id, None)
+        raise
+
+    return msg_id
+
+
+def _handle_execute_result(content, exec_state):
+    """Record the plain-text value of an expression result."""
+    result = content.get("data", {}).get("text/plain", "")
+    if result:
+        exec_state.results.append(result)
+
+
+def _handle_stream(content, exec_state):
+    """Record stdout/stderr text."""
+    stream_text = content.get("text", "").strip()
+    if stream_text:
+        exec_state.streams.append(stream_text)
+
+
+def _handle_error(content, exec_state):
+    """Record an exception with its ANSI-stripped traceback."""
+    error_name = content.get("ename", "Error")
+    error_value = content.get("evalue", "")
+    traceback = content.get("traceback", [])
+
+    error_msg = f"{error_name}: {error_value}"
+    if traceback:
+        # Clean up ANSI codes from traceback
+        clean_traceback = [ANSI_RE.sub("", line) for line in traceback]
+        error_msg += "\n" + "\n".join(clean_traceback)
+    exec_state.errors.append(error_msg)
+
+
+def _handle_status(content, exec_state):
+    """Mark the execution finished once the kernel goes idle."""
+    if content.get("execution_state") == "idle":
+        exec_state.finished_at = time.monotonic()
+        exec_state.finished.set()
+
+
+# IOPub msg_type -> handler recording that message in an ExecState; other types are ignored
+_HANDLERS = {
+    "execute_result": _handle_execute_result,
+    "stream": _handle_stream,
+    "error": _handle_error,
+    "status": _handle_status,
+}
+
+
+def _reap_pending_executions():
+    """Forget executions finished more than PENDING_TTL ago once the table grows past PENDING_REAP_THRESHOLD."""
+    if len(pending_executions) <= PENDING_REAP_THRESHOLD:
         return
 
+    now = time.monotonic()
+    expired = [
+        msg_id for msg_id, exec_state in pending_executions.items()
+        if exec_state.done and now - exec_state.finished_at > PENDING_TTL
+    ]
+    for msg_id in expired:
+        del pending_executions[msg_id]
+
+
+def _process_iopub_messages(sock, session, signer):
+    """
+    Drain sock (the IOPub socket), routing each message to its pending execution by parent msg_id.
+    
+    session is our session id as bytes. Replies to our requests carry it in
+    their parent_header, so any frame without it belongs to another client
+    and is dropped with a substring check before any JSON is decoded.
+    signer is the pre-keyed HMAC used to reject forged or foreign-key
+    messages, also before decoding; None when the kernel runs unsigned.
+    """
+    global pending_executions
+
+    _reap_pending_executions()
+
     while True:
         try:
-            msg = iopub_socket.recv_multipart(zmq.NOBLOCK)
+            # Frames reference libzmq's buffers; only the small parent_header
+            # is copied out, header/content are parsed straight from .buffer
+            msg = sock.recv_multipart(zmq.NOBLOCK, copy=False)
         except zmq.Again:
             break
 
         if len(msg) < 7:
             continue
 
-        header = json.loads(msg[3])
-        parent_header = json.loads(msg[4]) if len(msg) > 4 and msg[4] else {}
-        content = json.loads(msg[6])
+        parent_bytes = msg[4].bytes
+        if session not in parent_bytes:
+            continue
 
-        msg_id = parent_header.get("msg_id")
-        if msg_id not in pending_executions:
+        if signer is not None:
+            h = signer.copy()
+            for frame in msg[3:7]:
+                h.update(frame.buffer)
+            if not hmac.compare_digest(h.hexdigest().encode(), msg[2].bytes):
+                continue
+
+        # Decode the small parent_header first; header and content are only
+        # parsed for replies to our own requests (most IOPub traffic is not)
+        parent_header = orjson.loads(parent_bytes)
+        exec_state = pending_executions.get(parent_header.get("msg_id"))
+        if exec_state is None:
             continue
 
-        exec_state = pending_executions[msg_id]
-        msg_type = header.get("msg_type")
+        # Content (the largest frame) is only decoded for types we record;
+        # execute_input echoes, display_data, comm traffic etc. are skipped
+        header = orjson.loads(msg[3].buffer)
+        handler = _HANDLERS.get(header.get("msg_type"))
+        if handler:
+            handler(orjson.loads(msg[6].buffer), exec_state)
+
 
-        if msg_type == "execute_result":
-            result = content.get("data", {}).get("text/plain", "")
-            if result:
-                exec_state["results"].append(result)
+def _iopub_loop(sock, session, signer, stop):
+    """
+    Body of the IOPub reader thread: collect output until stop is set.
 
-        elif msg_type == "stream":
-            stream_text = content.get("text", "").strip()
-            if stream_text:
-                exec_state["streams"].append(stream_text)
+    This thread is the only user of sock, so output keeps flowing into
+    pending_executions (and the socket queue never fills) even while
+    nobody is calling check_execution.
+    """
+    poller = zmq.Poller()
+    poller.register(sock, zmq.POLLIN)
 
-        elif msg_type == "error":
-            error_name = content.get("ename", "Error")
-            error_value = content.get("evalue", "")
-            traceback = content.get("traceback", [])
+    while not stop.is_set():
+        if poller.poll(IOPUB_POLL_INTERVAL_MS):
+            with _state_lock:
+                _process_iopub_messages(sock, session, signer)
 
-            error_msg = f"{error_name}: {error_value}"
-            if traceback:
-                clean_traceback = []
-                for line in traceback:
-                    clean_line = (
-                        line.replace("\x1b[0;31m", "")
-                        .replace("\x1b[0m", "")
-                        .replace("\x1b[1;32m", "")
-                        .replace("\x1b[0;32m", "")
-                    )
-                    clean_traceback.append(clean_line)
-                error_msg += "\n" + "\n".join(clean_traceback)
-            exec_state["errors"].append(error_msg)
 
-        elif msg_type == "status":
-            if content.get("execution_state") == "idle":
-                exec_state["done"] = True
+def _stop_iopub_thread():
+    """Stop the IOPub reader thread, if running, and wait for it to release its socket."""
+    global iopub_thread, iopub_thread_stop
 
+    if iopub_thread:
+        iopub_thread_stop.set()
+        iopub_thread.join()
+        iopub_thread = None
+        iopub_thread_stop = None
+
+
+def _poll_until(msg_ids, timeout):
+    """
+    Block until every execution in msg_ids goes idle or timeout seconds pass.
+
+    Returns:
+        True if all executions finished, False on timeout
+    """
+    with _state_lock:
+        exec_states = [pending_executions[msg_id] for msg_id in msg_ids]
+    deadline = time.monotonic() + timeout
+
+    for exec_state in exec_states:
+        if not exec_state.finished.wait(max(0, deadline - time.monotonic())):
+            return False
+
+    return True
+
+
+async def _wait_async(msg_ids, timeout):
+    """
+    Await _poll_until on a worker thread so the MCP event loop stays free.
+    
+    Blocking tools are async so that other tool calls (check_execution,
+    interrupt_execution, ...) can be served while they wait on the kernel.
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(None, _poll_until, msg_ids, timeout)
+
+
+def _wait_for_reply(sock, msg_id, timeout):
+    """
+    Wait for the reply to request msg_id on sock (the shell or control socket).
+
+    Replies to earlier requests that nobody waited for (execute_reply for
+    execute_code, interrupt_reply etc.) are discarded along the way.
+
+    Returns:
+        Decoded reply content, or None on timeout
+    """
+    deadline = time.monotonic() + timeout
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0 or not sock.poll(remaining * 1000, zmq.POLLIN):
+            return None
+
+        while True:
+            try:
+                msg = sock.recv_multipart(zmq.NOBLOCK, copy=False)
+            except zmq.Again:
+                break
+
+            if len(msg) < 7:
+                continue
+
+            parent_header = orjson.loads(msg[4].buffer) if len(msg[4]) else {}
+            if parent_header.get("msg_id") == msg_id:
+                return orjson.loads(msg[6].buffer)
+
+
+def _warm_up_kernel(timeout):
+    """
+    Round-trip kernel_info_requests on the control socket until IOPub sees one
+    go idle, so the first real execution does not pay for the connect and
+    subscription handshakes.
+
+    The control channel answers while a cell is running on shell, and the
+    kernel only answers correctly signed requests, so a reply confirms the
+    HMAC key. A SUB socket can miss messages published before its subscription
+    reaches the kernel, so the request is repeated until an idle status arrives.
+
+    Returns:
+        None if a reply and its idle status were observed, otherwise a warning
+        describing what was missing
+    """
+    deadline = time.monotonic() + timeout
+    answered = False
+
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+
+        msg_id = _new_msg_id()
+        # Tracked like an execution so the IOPub reader flags its idle status
+        exec_state = ExecState()
+        with _state_lock:
+            pending_executions[msg_id] = exec_state
+
+        try:
+            try:
+                _send_message(control_socket, msg_id, "kernel_info_request", EMPTY_FRAME)
+            except ConnectionError:
+                # Nothing listening yet; stay connected so the kernel can still come up later
+                break
+            if _wait_for_reply(control_socket, msg_id, remaining) is None:
+                break
+            answered = True
+            if exec_state.finished.wait(min(WARMUP_RETRY_INTERVAL, max(0, deadline - time.monotonic()))):
+                return None
+        finally:
+            with _state_lock:
+                pending_executions.pop(msg_id, None)
+
+    if not answered:
+        return "⚠️ Kernel did not answer kernel_info_request on the control channel; check that it is running and the key matches"
+    return "⚠️ Kernel answered but no IOPub status arrived; output may be missing"
+
+
+def _format_output(exec_state):
+    """Collect the output of an execution as a list of display lines."""
+    return [*exec_state.streams, *exec_state.results, *(f"❌ {err}" for err in exec_state.errors)]
+
+
+def _render_blocking_result(exec_state):
+    """Format a blocking execution's output, with an explicit warning if it did not finish in time."""
+    output_parts = _format_output(exec_state)
+    
+    # Check if execution timed out
+    if not exec_state.done:
+        # Execution timed out - be explicit about it
+        timeout_msg = f"⚠️ Execution timed out after ~{EXEC_TIMEOUT:g} second{'' if EXEC_TIMEOUT == 1 else 's'}. Code may still be running in background."
+        
+        # Include any partial output we got
+        if output_parts:
+            return f"{timeout_msg}\n\nPartial output:\n" + "\n".join(output_parts)
+        else:
+            return f"{timeout_msg} Use execute_code_nonblocking for long operations."
+    
+    if not output_parts:
+        return "✅ Code executed successfully (no output)"
+    
+    return "\n".join(output_parts)
+
+
+def _load_connection_file(connection_path):
+    """
+    Parse a kernel connection file and validate its required fields and their types.
+
+    Returns:
+        (connection_info, None) on success, or (None, error message) if the file is invalid
+    """
+    connection_info = orjson.loads(connection_path.read_bytes())
+    
+    missing_fields = [field for field in CONNECTION_FIELDS if field not in connection_info]
+    if missing_fields:
+        return None, f"❌ Connection file missing required fields: {missing_fields}"
+    invalid_fields = [field for field, kind in CONNECTION_FIELDS.items()
+                      if not isinstance(connection_info[field], kind)]
+    if invalid_fields:
+        return None, f"❌ Connection file has fields of the wrong type: {invalid_fields}"
+    
+    return connection_info, None
+
+
+def _port_open(ip, port):
+    """Return True if something accepts TCP connections on ip:port."""
+    try:
+        socket.create_connection((ip, port), timeout=0.1).close()
+        return True
+    except OSError:
+        return False
+
+
+def _wait_for_port(ip, port, timeout):
+    """Poll ip:port until it accepts connections, kernel_process exits, or timeout seconds pass."""
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline and kernel_process.poll() is None:
+        if _port_open(ip, port):
+            return
+        time.sleep(0.05)
+
+
+def _remove_pid_file(path):
+    """Delete a kernel PID file written by start_kernel, if it still exists."""
+    _pid_files.pop(path, None)
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _remove_pid_files():
+    """atexit hook: delete the PID files of kernels that are no longer running.
+
+    Kernels are detached and outlive the server, so a running kernel keeps its
+    PID file for later cleanup.
+    """
+    for path, process in list(_pid_files.items()):
+        if process.poll() is not None:
+            _remove_pid_file(path)
+
+
+atexit.register(_remove_pid_files)
 
 
 @mcp.tool()
@@ -160,31 +687,54 @@ def start_kernel(connection_file: str = None) -> str:
         if not connection_path.exists():
             return f"❌ Connection file not found: {connection_path}"
         
+        connection_info, error = _load_connection_file(connection_path)
+        if error:
+            return error
+        
+        # A kernel (e.g. from an earlier start_kernel) or another process already
+        # on these ports would make the new kernel exit with "address in use",
+        # while the readiness check below saw the old listener and reported success
+        ip = connection_info['ip']
+        busy_ports = [connection_info[field] for field in KERNEL_PORT_FIELDS
+                      if _port_open(ip, connection_info[field])]
+        if busy_ports:
+            return (f"❌ Port already in use on {ip}: {busy_ports}\n"
+                    "A kernel may already be running with this connection file; use connect_to_kernel() instead")
+        
         # Start IPython kernel in background using the connection file
         cmd = [
             "ipython", "kernel",
             f"--ConnectionFileMixin.connection_file={connection_path}"
         ]
         
+        # Kernel logs are discarded unless debugging: an unread PIPE blocks the
+        # kernel once it has written a pipe buffer's worth of output
+        debug = bool(os.environ.get('IPYTHON_MCP_DEBUG'))
+        output = subprocess.PIPE if debug else subprocess.DEVNULL
+        
         # Start process detached (won't die when MCP server closes)
         kernel_process = subprocess.Popen(
             cmd,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
+            stdout=output,
+            stderr=output,
             start_new_session=True,  # Detach from parent process
         )
         
         # Save PID for later cleanup
-        temp_dir = tempfile.mkdtemp(prefix="ipython-mcp-")
-        kernel_pid_file = os.path.join(temp_dir, f"kernel-{kernel_process.pid}.pid")
+        kernel_pid_file = os.path.join(tempfile.gettempdir(), f"ipython-mcp-{kernel_process.pid}.pid")
         with open(kernel_pid_file, 'w') as f:
             f.write(str(kernel_process.pid))
+        _pid_files[kernel_pid_file] = kernel_process
         
-        # Wait a moment for kernel to start
-        time.sleep(2)
+        # Wait until the kernel has bound its shell port (or died trying), then
+        # give it a moment to fail on any of its other ports
+        _wait_for_port(ip, connection_info['shell_port'], KERNEL_START_TIMEOUT)
+        if kernel_process.poll() is None:
+            time.sleep(KERNEL_SETTLE_DELAY)
         
         # Check if kernel started successfully
         if kernel_process.poll() is not None:
+            _remove_pid_file(kernel_pid_file)
             stdout, stderr = kernel_process.communicate()
             stdout_text = stdout.decode('utf-8') if stdout else ""
             stderr_text = stderr.decode('utf-8') if stderr else ""
@@ -193,8 +743,13 @@ def start_kernel(connection_file: str = None) -> str:
                 error_details += f"\nStdout: {stdout_text}"
             if stderr_text:
                 error_details += f"\nStderr: {stderr_text}"
+            if not debug:
+                error_details += "\nSet IPYTHON_MCP_DEBUG=1 to capture kernel output"
             return f"❌ Kernel failed to start\n{error_details}"
         
+        if not _port_open(ip, connection_info['shell_port']):
+            return f"❌ Kernel (PID: {kernel_process.pid}) did not open its shell port within {KERNEL_START_TIMEOUT:g}s"
+        
         # Auto-connect to the kernel
         connect_result = connect_to_kernel(str(connection_path))
         
@@ -216,7 +771,7 @@ def connect_to_kernel(connection_file: str = None) -> str:
     Returns:
         Connection status message
     """
-    global kernel_connection, context, shell_socket, iopub_socket, control_socket
+    global kernel_connection, shell_socket, iopub_socket, control_socket, iopub_thread, iopub_thread_stop, hmac_template
     
     try:
         # Resolve connection file using priority logic
@@ -226,30 +781,25 @@ def connect_to_kernel(connection_file: str = None) -> str:
         if not connection_path.exists():
             return f"❌ Connection file not found: {connection_path}"
         
-        with open(connection_path, 'r') as f:
-            kernel_connection = json.load(f)
-            
-        # Validate connection file has required fields
-        required_fields = ['ip', 'shell_port', 'iopub_port', 'stdin_port', 'control_port', 'hb_port', 'key']
-        missing_fields = [field for field in required_fields if field not in kernel_connection]
-        if missing_fields:
-            return f"❌ Connection file missing required fields: {missing_fields}"
+        connection_info, error = _load_connection_file(connection_path)
+        if error:
+            return error
+        kernel_connection = connection_info
+        
+        # Key the HMAC once; sign_message() copies this pre-keyed state per message
+        hmac_template = hmac.new(kernel_connection['key'].encode('utf-8'), digestmod=hashlib.sha256)
         
         # Close existing connections if any
+        _stop_iopub_thread()
         if shell_socket:
-            shell_socket.close()
+            shell_socket.close(linger=0)
         if iopub_socket:
-            iopub_socket.close()
+            iopub_socket.close(linger=0)
         if control_socket:
-            control_socket.close()
-        if context:
-            context.term()
-        
-        # Create new ZMQ context and sockets
-        context = zmq.Context()
+            control_socket.close(linger=0)
         
         # Shell socket for sending requests
-        shell_socket = context.socket(zmq.DEALER)
+        shell_socket = _new_socket(zmq.DEALER)
         shell_addr = f"tcp://{kernel_connection['ip']}:{kernel_connection['shell_port']}"
         try:
             shell_socket.connect(shell_addr)
@@ -257,36 +807,55 @@ def connect_to_kernel(connection_file: str = None) -> str:
             return f"❌ Failed to connect to shell socket {shell_addr}: {str(e)}"
         
         # IOPub socket for receiving output
-        iopub_socket = context.socket(zmq.SUB)
+        iopub_socket = _new_socket(zmq.SUB)
         iopub_addr = f"tcp://{kernel_connection['ip']}:{kernel_connection['iopub_port']}"
         try:
-            iopub_socket.connect(iopub_addr)
+            # Subscribe before connecting so nothing published during the handshake is dropped
             iopub_socket.setsockopt(zmq.SUBSCRIBE, b'')
+            iopub_socket.connect(iopub_addr)
         except Exception as e:
             return f"❌ Failed to connect to iopub socket {iopub_addr}: {str(e)}"
         
+        # Background reader that routes IOPub output into pending_executions.
+        # An empty key means the kernel does not sign messages, so nothing to verify.
+        signer = hmac_template if kernel_connection['key'] else None
+        iopub_thread_stop = threading.Event()
+        iopub_thread = threading.Thread(
+            target=_iopub_loop,
+            args=(iopub_socket, SESSION_BYTES, signer, iopub_thread_stop),
+            daemon=True,
+        )
+        iopub_thread.start()
+        
         # Control socket for sending interrupts
-        control_socket = context.socket(zmq.DEALER)
+        control_socket = _new_socket(zmq.DEALER)
         control_addr = f"tcp://{kernel_connection['ip']}:{kernel_connection['control_port']}"
         try:
             control_socket.connect(control_addr)
         except Exception as e:
             return f"❌ Failed to connect to control socket {control_addr}: {str(e)}"
         
-        return f"✅ Connected to IPython kernel at {kernel_connection['ip']}:{kernel_connection['shell_port']}\n📁 Connection file: {connection_path}\n🔑 Using key: {kernel_connection['key'][:8]}..."
+        status = f"✅ Connected to IPython kernel at {kernel_connection['ip']}:{kernel_connection['shell_port']}\n📁 Connection file: {connection_path}\n🔑 Using key: {kernel_connection['key'][:8]}..."
+        
+        warning = _warm_up_kernel(WARMUP_TIMEOUT)
+        if warning:
+            status += f"\n{warning}"
+        
+        return status
         
     except Exception as e:
         return f"❌ Failed to connect: {str(e)}"
 
 
 @mcp.tool()
-def execute_code(code: str) -> str:
+async def execute_code(code: str) -> str:
     """
     Execute Python code on the IPython kernel and WAIT for completion.
     
-    ⚠️  WARNING: This will BLOCK until execution finishes with ~1 second timeout. 
-    If timeout occurs, returns explicit timeout warning. Use execute_code_nonblocking 
-    for long-running operations like file downloads, ML training, large data processing.
+    ⚠️  WARNING: This will BLOCK until execution finishes with ~1 second timeout
+    (set IPYTHON_MCP_EXEC_TIMEOUT to change it). If timeout occurs, returns explicit
+    timeout warning. Use execute_code_nonblocking for long-running operations like
+    file downloads, ML training, large data processing.
     
     Args:
         code: Python code to execute
@@ -300,150 +869,62 @@ def execute_code(code: str) -> str:
         return "❌ Not connected to kernel. Use connect_to_kernel() first."
     
     try:
-        # Create execute request message
-        msg_id = str(uuid.uuid4())
-        session_id = str(uuid.uuid4())
-        
-        header = {
-            "msg_id": msg_id,
-            "username": "ipython-mcp",
-            "session": session_id,
-            "date": datetime.now().isoformat(),
-            "msg_type": "execute_request",
-            "version": "5.3"
-        }
-        
-        content = {
-            "code": code,
-            "silent": False,
-            "store_history": True,
-            "user_expressions": {},
-            "allow_stdin": False,
-            "stop_on_error": True
-        }
-        
-        # Prepare and sign message
-        msg_parts = [
-            json.dumps(header).encode('utf-8'),
-            b'{}',  # parent_header
-            b'{}',  # metadata
-            json.dumps(content).encode('utf-8')
-        ]
-        
-        signature = sign_message(msg_parts, kernel_connection['key'])
-        
-        # Send message
-        shell_socket.send_multipart([
-            b'',
-            b'<IDS|MSG>',
-            signature,
-            msg_parts[0],
-            msg_parts[1],
-            msg_parts[2],
-            msg_parts[3]
-        ])
-        
-        # Collect output
-        results = []
-        errors = []
-        streams = []
-        
-        # Wait for execution to complete
-        execution_done = False
-        timeout_count = 0
-        
-        while not execution_done and timeout_count < 100:
-            try:
-                msg = iopub_socket.recv_multipart(zmq.NOBLOCK)
-                if len(msg) >= 7:
-                    header = json.loads(msg[3])
-                    parent_header = json.loads(msg[4]) if len(msg) > 4 and msg[4] else {}
-                    content = json.loads(msg[6])
-                    
-                    # Only process messages that are replies to our request
-                    if parent_header.get('msg_id') != msg_id:
-                        continue
-                    
-                    msg_type = header.get('msg_type')
-                    
-                    if msg_type == 'execute_result':
-                        result = content.get('data', {}).get('text/plain', '')
-                        if result:
-                            results.append(result)
-                    
-                    elif msg_type == 'stream':
-                        stream_text = content.get('text', '').strip()
-                        if stream_text:
-                            streams.append(stream_text)
-                    
-                    elif msg_type == 'error':
-                        error_name = content.get('ename', 'Error')
-                        error_value = content.get('evalue', '')
-                        traceback = content.get('traceback', [])
-                        
-                        error_msg = f"{error_name}: {error_value}"
-                        if traceback:
-                            # Clean up ANSI codes from traceback
-                            clean_traceback = []
-                            for line in traceback:
-                                # Simple ANSI code removal (basic)
-                                clean_line = line.replace('\x1b[0;31m', '').replace('\x1b[0m', '')
-                                clean_line = clean_line.replace('\x1b[1;32m', '').replace('\x1b[0;32m', '')
-                                clean_traceback.append(clean_line)
-                            error_msg += "\n" + "\n".join(clean_traceback)
-                        errors.append(error_msg)
-                    
-                    elif msg_type == 'status':
-                        if content.get('execution_state') == 'idle':
-                            execution_done = True
-                
-                timeout_count = 0  # Reset timeout if we got a message
-                
-            except zmq.Again:
-                timeout_count += 1
-                time.sleep(0.01)
-        
-        # Check if execution timed out
-        if not execution_done:
-            # Execution timed out - be explicit about it
-            timeout_msg = "⚠️ Execution timed out after ~1 second. Code may still be running in background."
-            
-            # Include any partial output we got
-            output_parts = []
-            for stream in streams:
-                output_parts.append(stream)
-            for result in results:
-                output_parts.append(result)
-            for error in errors:
-                output_parts.append(f"❌ {error}")
-            
-            if output_parts:
-                return f"{timeout_msg}\n\nPartial output:\n" + "\n".join(output_parts)
-            else:
-                return f"{timeout_msg} Use execute_code_nonblocking for long operations."
-        
-        # Format output for successful completion
-        output_parts = []
-        
-        # Add streams (print output)
-        for stream in streams:
-            output_parts.append(stream)
-        
-        # Add results (expression values)
-        for result in results:
-            output_parts.append(result)
-        
-        # Add errors
-        for error in errors:
-            output_parts.append(f"❌ {error}")
+        msg_id = _send_execute_request(code)
+        await _wait_async([msg_id], EXEC_TIMEOUT)
+        with _state_lock:
+            exec_state = pending_executions.pop(msg_id)
+        return _render_blocking_result(exec_state)
+
+    except Exception as e:
+        return f"❌ Execution failed: {str(e)}"
+
+
+@mcp.tool()
+async def execute_many(codes: List[str]) -> List[str]:
+    """
+    Execute several Python snippets on the IPython kernel and WAIT for all of them.
+    
+    All snippets are sent back-to-back before any output is read, so N small
+    snippets (variable probes, introspection) cost one round of waiting instead
+    of N. The kernel runs them in order; if one raises, the kernel skips the
+    rest. Shares execute_code's timeout across the whole batch.
+    
+    Args:
+        codes: Python code snippets to execute, in order
         
-        if not output_parts:
-            return "✅ Code executed successfully (no output)"
+    Returns:
+        One result per snippet, in the same order, formatted like execute_code
+    """
+    global kernel_connection, shell_socket, iopub_socket
+    
+    if not kernel_connection or not shell_socket or not iopub_socket:
+        return ["❌ Not connected to kernel. Use connect_to_kernel() first."] * len(codes)
+    
+    msg_ids = []
+    try:
+        for code in codes:
+            msg_ids.append(_send_execute_request(code))
+        await _wait_async(msg_ids, EXEC_TIMEOUT)
+        with _state_lock:
+            exec_states = [pending_executions.pop(msg_id) for msg_id in msg_ids]
         
-        return "\n".join(output_parts)
+        outputs = []
+        failed = False
+        for exec_state in exec_states:
+            # The kernel aborts every request queued behind one that raised
+            if failed and exec_state.done and not _format_output(exec_state):
+                outputs.append("⏭️ Not executed: an earlier snippet raised an error")
+                continue
+            failed = failed or bool(exec_state.errors)
+            outputs.append(_render_blocking_result(exec_state))
+        return outputs
 
     except Exception as e:
-        return f"❌ Execution failed: {str(e)}"
+        # Stop tracking whatever was already sent; unfinished entries are never reaped
+        with _state_lock:
+            for msg_id in msg_ids:
+                pending_executions.pop(msg_id, None)
+        return [f"❌ Execution failed: {str(e)}"] * len(codes)
 
 
 @mcp.tool()
@@ -466,46 +947,7 @@ def execute_code_nonblocking(code: str) -> str:
         return "❌ Not connected to kernel. Use connect_to_kernel() first."
 
     try:
-        msg_id = str(uuid.uuid4())
-        session_id = str(uuid.uuid4())
-
-        header = {
-            "msg_id": msg_id,
-            "username": "ipython-mcp",
-            "session": session_id,
-            "date": datetime.now().isoformat(),
-            "msg_type": "execute_request",
-            "version": "5.3",
-        }
-
-        content = {
-            "code": code,
-            "silent": False,
-            "store_history": True,
-            "user_expressions": {},
-            "allow_stdin": False,
-            "stop_on_error": True,
-        }
-
-        msg_parts = [
-            json.dumps(header).encode("utf-8"),
-            b"{}",
-            b"{}",
-            json.dumps(content).encode("utf-8"),
-        ]
-
-        signature = sign_message(msg_parts, kernel_connection["key"])
-
-        shell_socket.send_multipart(
-            [b"", b"<IDS|MSG>", signature, msg_parts[0], msg_parts[1], msg_parts[2], msg_parts[3]]
-        )
-
-        pending_executions[msg_id] = {
-            "results": [],
-            "streams": [],
-            "errors": [],
-            "done": False,
-        }
+        msg_id = _send_execute_request(code)
 
         return f"✅ Started execution {msg_id}"
 
@@ -528,21 +970,18 @@ def check_execution(msg_id: str) -> str:
     """
     global pending_executions
 
-    if msg_id not in pending_executions:
-        return "❌ Unknown execution id"
-
-    _process_iopub_messages()
+    # The IOPub reader thread keeps the state current; just take a snapshot
+    with _state_lock:
+        state = pending_executions.get(msg_id)
+        if state is None:
+            return "❌ Unknown execution id"
 
-    state = pending_executions[msg_id]
+        output_parts = _format_output(state)
+        done = state.done
+        if done:
+            del pending_executions[msg_id]
 
-    output_parts = []
-    output_parts.extend(state["streams"])
-    output_parts.extend(state["results"])
-    for err in state["errors"]:
-        output_parts.append(f"❌ {err}")
-
-    if state["done"]:
-        del pending_executions[msg_id]
+    if done:
         if not output_parts:
             return "✅ Code executed successfully (no output)"
         return "\n".join(output_parts)
@@ -563,14 +1002,37 @@ def variable_exists(var_name: str) -> str:
     Returns:
         "true" if variable exists, "false" if not, or timeout warning if execution failed
     """
-    code = f"print('true' if '{var_name}' in globals() else 'false')"
-    result = execute_code(code)
+    global kernel_connection, shell_socket
     
-    # If timeout occurred, return the timeout message as-is
-    if "timed out" in result:
-        return result
+    if not kernel_connection or not shell_socket:
+        return "❌ Not connected to kernel. Use connect_to_kernel() first."
     
-    return result.strip()
+    try:
+        # Evaluate the check as a user_expression of an empty, silent execution:
+        # the answer comes back in the shell reply, with no IOPub output to collect.
+        # repr() keeps var_name from being interpreted as code.
+        msg_id = _new_msg_id()
+        content = {**SILENT_CONTENT_STATIC, "user_expressions": {"exists": f"{var_name!r} in globals()"}}
+        _send_message(shell_socket, msg_id, "execute_request", orjson.dumps(content))
+        
+        reply = _wait_for_reply(shell_socket, msg_id, 1.0)
+        if reply is None:
+            return "⚠️ Execution timed out after ~1 second. Kernel may be busy with another execution."
+        
+        # With stop_on_error the kernel aborts requests queued behind a cell that raised
+        if reply.get("status") == "aborted":
+            return "⚠️ Check aborted: an earlier execution raised an error. Try again."
+        if reply.get("status") != "ok":
+            return f"❌ {reply.get('ename', 'Error')}: {reply.get('evalue', '')}"
+        
+        expression = reply.get("user_expressions", {}).get("exists", {})
+        if expression.get("status") != "ok":
+            return f"❌ {expression.get('ename', 'Error')}: {expression.get('evalue', '')}"
+        
+        return "true" if expression.get("data", {}).get("text/plain") == "True" else "false"
+        
+    except Exception as e:
+        return f"❌ Execution failed: {str(e)}"
 
 
 @mcp.tool()
@@ -604,22 +1066,21 @@ def disconnect_kernel() -> str:
     Returns:
         "✅ Disconnected from kernel" on success, or error message if disconnect fails
     """
-    global kernel_connection, context, shell_socket, iopub_socket, control_socket
+    global kernel_connection, shell_socket, iopub_socket, control_socket, hmac_template
     
     try:
+        _stop_iopub_thread()
         if shell_socket:
-            shell_socket.close()
+            shell_socket.close(linger=0)
             shell_socket = None
         if iopub_socket:
-            iopub_socket.close()
+            iopub_socket.close(linger=0)
             iopub_socket = None
         if control_socket:
-            control_socket.close()
+            control_socket.close(linger=0)
             control_socket = None
-        if context:
-            context.term()
-            context = None
         
+        hmac_template = None
         kernel_connection = None
         return "✅ Disconnected from kernel"
         
@@ -647,50 +1108,18 @@ def interrupt_execution(msg_id: str) -> str:
     if not kernel_connection or not control_socket:
         return "❌ Not connected to kernel. Use connect_to_kernel() first."
     
-    if msg_id not in pending_executions:
-        return f"❌ No pending execution found with ID: {msg_id}"
+    with _state_lock:
+        if msg_id not in pending_executions:
+            return f"❌ No pending execution found with ID: {msg_id}"
     
     try:
-        # Create interrupt request message
-        interrupt_msg_id = str(uuid.uuid4())
-        session_id = str(uuid.uuid4())
-        
-        header = {
-            "msg_id": interrupt_msg_id,
-            "username": "ipython-mcp",
-            "session": session_id,
-            "date": datetime.now().isoformat(),
-            "msg_type": "interrupt_request",
-            "version": "5.3",
-        }
-        
-        parent_header = {}
-        metadata = {}
-        content = {}
-        
-        # Prepare message parts
-        msg_parts = [
-            json.dumps(header).encode("utf-8"),
-            json.dumps(parent_header).encode("utf-8"),
-            json.dumps(metadata).encode("utf-8"),
-            json.dumps(content).encode("utf-8"),
-        ]
-        
-        # Sign and send interrupt message to control socket
-        signature = sign_message(msg_parts, kernel_connection["key"])
-        control_socket.send_multipart([
-            b"", 
-            b"<IDS|MSG>", 
-            signature, 
-            msg_parts[0], 
-            msg_parts[1], 
-            msg_parts[2], 
-            msg_parts[3]
-        ])
+        # Send interrupt request to control socket
+        _send_message(control_socket, _new_msg_id(), "interrupt_request", EMPTY_FRAME)
         
         # Mark execution as interrupted (will be cleaned up by status check)
-        if msg_id in pending_executions:
-            pending_executions[msg_id]["interrupted"] = True
+        with _state_lock:
+            if msg_id in pending_executions:
+                pending_executions[msg_id].interrupted = True
         
         return f"✅ Interrupt request sent for execution {msg_id}\n💡 Use check_execution() to verify cancellation status"
         
@@ -698,11 +1127,23 @@ def interrupt_execution(msg_id: str) -> str:
         return f"❌ Failed to send interrupt: {str(e)}"
 
 
+def _shutdown_watcher():
+    """Wait for a shutdown signal, then close kernel connections and exit the process."""
+    _shutdown_event.wait()
+    disconnect_kernel()
+    # os._exit() skips atexit hooks, so run their cleanup here
+    _remove_pid_files()
+    _release_context()
+    os._exit(0)
+
+
 def main():
     """Main entry point for the MCP server"""
-    # Clean shutdown on signals
-    signal.signal(signal.SIGTERM, lambda sig, frame: disconnect_kernel())
-    signal.signal(signal.SIGINT, lambda sig, frame: disconnect_kernel())
+    # Clean shutdown on signals. The handlers only set a flag: closing sockets
+    # inside a signal handler can deadlock against the code it interrupted.
+    signal.signal(signal.SIGTERM, lambda sig, frame: _shutdown_event.set())
+    signal.signal(signal.SIGINT, lambda sig, frame: _shutdown_event.set())
+    threading.Thread(target=_shutdown_watcher, daemon=True).start()
     mcp.run()
 
 